@@ -13,10 +13,22 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import array
+import concurrent.futures
+import contextlib
+import cProfile
+import hashlib
 import heapq
+import json
+import mmap
 import os
 import posixpath
 import re
+import struct
+import sys
+import threading
+import time
+import zlib
 import datetime
 
 import pygit2
@@ -175,14 +187,162 @@ redate_map = {
 rearrange_date = datetime.datetime(2011, 3, 17, 19, 32).timestamp()
 cvs_end_date = datetime.datetime(2019, 5, 1).timestamp()
 
-class Commit:
-    def __lt__(a, b):
-        return (a.committer.time, a.oid) < (b.committer.time, b.oid)
-    def __iter__(c):
-        yield c
-        while c.parents:
-            c = c.parents[0]
-            yield c
+class Stats:
+    # Counts of objects written, and time spent on each kind of work
+    def __init__(self):
+        self.start = time.monotonic()
+        self.counts = dict.fromkeys(("commits", "trees", "blobs"), 0)
+        self.timers = dict.fromkeys(("fetch", "load", "write_trees", "create_commits"), 0.0)
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            # Fetches are timed from several threads
+            with self.lock:
+                self.timers[name] = self.timers.get(name, 0.0) + time.perf_counter() - start
+
+    def summary(self):
+        return {
+            "seconds": round(time.monotonic() - self.start, 3),
+            "counts": dict(self.counts),
+            "timers": {name: round(t, 3) for name, t in self.timers.items()}
+        }
+
+# Replaced by the programs for each product
+stats = Stats()
+
+# Seconds between progress reports from convert(), or None for no reports
+progress_interval = None
+
+def save_stats(path, data):
+    with open(path, "w") as f:
+        json.dump(data, f, indent=2)
+        f.write("\n")
+
+def profile(directory, name, func, *args):
+    # Calls func, saving a profile as name.prof if directory is not None
+    if directory is None:
+        return func(*args)
+    os.makedirs(directory, exist_ok=True)
+    p = cProfile.Profile()
+    try:
+        return p.runcall(func, *args)
+    finally:
+        p.dump_stats(os.path.join(directory, name + ".prof"))
+
+redate_times = {pygit2.Oid(hex=oid).raw: int(datetime.datetime.strptime(time, "%Y-%m-%dT%H:%M:%S.%fZ").timestamp())
+                for oid, time in redate_map.items()}
+
+class CommitStore:
+    # Compact record of the first-parent histories of the branches in a
+    # repository, loaded when requested. Everything else is read from the
+    # repository when needed.
+    def __init__(self, repo, prefix="refs/heads/"):
+        self.repo = repo
+        self.prefix = prefix
+        self.branches = dict()
+        self.indices = dict()
+        self.oids = bytearray()
+        self.times = array.array("q")
+        self.min_times = array.array("q")
+        self.parents = array.array("l")
+
+    def load(self, oid):
+        # Returns the index of a commit, loading it and its first parents
+        chain = []
+        parent = self.indices.get(oid.raw)
+        while parent is None:
+            c = self.repo[oid]
+            # Only keep what is needed, not the whole commit
+            chain.append((oid.raw, c.committer.time))
+            if not c.parent_ids:
+                parent = -1
+                break
+            oid = c.parent_ids[0]
+            parent = self.indices.get(oid.raw)
+
+        min_time = self.min_times[parent] if parent >= 0 else 0
+        for raw, time in reversed(chain):
+            if time < min_time:
+                time = min_time
+            new_time = redate_times.get(raw)
+            if new_time is not None and new_time > min_time:
+                min_time = new_time
+            self.indices[raw] = len(self.times)
+            self.oids += raw
+            self.times.append(time)
+            self.min_times.append(min_time)
+            self.parents.append(parent)
+            parent = len(self.times) - 1
+        return parent
+
+    def __getitem__(self, name):
+        b = self.branches.get(name)
+        if b is None:
+            target = self.repo.lookup_reference(self.prefix + name).target
+            if not isinstance(target, pygit2.Oid):
+                raise KeyError(name)
+            c = self.repo[target]
+            while isinstance(c, pygit2.Tag):
+                c = self.repo[c.target]
+            b = self.branch(c.id)
+            self.branches[name] = b
+        return b
+
+    def branch(self, oid):
+        l = array.array("l")
+        with stats.timer("load"):
+            i = self.load(oid)
+        while i >= 0:
+            l.append(i)
+            i = self.parents[i]
+        return Branch(self, l)
+
+class Branch:
+    # First-parent history, newest commit first
+    def __init__(self, store, l):
+        self.store = store
+        self.list = l
+        self.mins = None
+    def __len__(self):
+        return len(self.list)
+    def raw_oid(self, i):
+        j = self.list[i] * 20
+        return bytes(self.store.oids[j:j + 20])
+    def oid(self, i):
+        return pygit2.Oid(raw=self.raw_oid(i))
+    def time(self, i):
+        return self.store.times[self.list[i]]
+    def key(self, i):
+        return (self.time(i), self.raw_oid(i))
+    def commit(self, i):
+        return self.store.repo[self.oid(i)]
+    def committer(self, i):
+        committer = self.commit(i).committer
+        if committer.time != self.time(i):
+            committer = pygit2.Signature(email=committer.email, name=committer.name, time=self.time(i))
+        return committer
+    def position(self, key):
+        # Find the newest commit not newer than key, searching from the
+        # newest commit. Times may go backwards, so binary search the
+        # position of the oldest commit so far at each index.
+        if self.mins is None:
+            self.mins = array.array("l", [0])
+            for i in range(1, len(self)):
+                self.mins.append(i if self.key(i) < self.key(self.mins[-1]) else self.mins[-1])
+        lo = 0
+        hi = len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.key(self.mins[mid]) <= key:
+                hi = mid
+            else:
+                lo = mid + 1
+        return lo
 
 class CommitPtr:
     def __init__(self, l, path, name):
@@ -191,103 +351,464 @@ class CommitPtr:
         self.name = name
         self.index = 0
     def __lt__(a, b):
-        return a.list[a.index] < b.list[b.index]
+        return a.list.key(a.index) < b.list.key(b.index)
     def get(self):
-        return self.list[self.index]
+        return self.list.commit(self.index)
+    def oid(self):
+        return self.list.oid(self.index)
+    def time(self):
+        return self.list.time(self.index)
+
+class TreeCache:
+    # Tree under construction, only the directories on the path to a
+    # change are written again.
+    def __init__(self, repo, oid=None):
+        self.repo = repo
+        self.oid = oid
+        self.base = oid
+        self.entries = dict()
+
+    def add(self, path, oid, mode):
+        tree = self
+        path = path.split("/")
+        for name in path[:-1]:
+            tree.oid = None
+            child = tree.entries.get(name)
+            if not isinstance(child, TreeCache):
+                base = None
+                if child is None and tree.base is not None:
+                    try:
+                        entry = tree.repo[tree.base][name]
+                    except KeyError:
+                        pass
+                    else:
+                        if entry.filemode == pygit2.GIT_FILEMODE_TREE:
+                            base = entry.id
+                child = TreeCache(tree.repo, base)
+                tree.entries[name] = child
+            tree = child
+        tree.oid = None
+        tree.entries[path[-1]] = (oid, mode)
+
+    def write(self):
+        if self.oid is None:
+            if self.base is None:
+                tb = self.repo.TreeBuilder()
+            else:
+                tb = self.repo.TreeBuilder(self.repo[self.base])
+            for name, entry in self.entries.items():
+                if isinstance(entry, TreeCache):
+                    tb.insert(name, entry.write(), pygit2.GIT_FILEMODE_TREE)
+                else:
+                    tb.insert(name, *entry)
+            self.oid = self.base = tb.write()
+            stats.counts["trees"] += 1
+            # Keep subdirectories, to avoid looking them up again
+            self.entries = {name: entry for name, entry in self.entries.items() if isinstance(entry, TreeCache)}
+        return self.oid
+
+class OidMap(dict):
+    # Mapping between object ids, saved by appending pairs of raw oids to
+    # a file. New entries are written by flush(), which must only be
+    # called once the objects they refer to have been written.
+    def __init__(self, path, rebuild=False):
+        super().__init__()
+        self.path = path
+        self.pending = bytearray()
+        if rebuild and os.path.exists(path):
+            os.remove(path)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return
+        end = len(data) - len(data) % 40
+        if end != len(data):
+            # Discard partially written entry
+            os.truncate(path, end)
+        for i in range(0, end, 40):
+            super().__setitem__(pygit2.Oid(raw=data[i:i + 20]), pygit2.Oid(raw=data[i + 20:i + 40]))
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.pending += key.raw + value.raw
+
+    def flush(self):
+        if self.pending:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, "ab") as f:
+                f.write(self.pending)
+            self.pending.clear()
+
+class PackWriter(pygit2.OdbBackend):
+    # Object database backend which keeps new objects in memory, and
+    # writes them to a single pack file when flushed, instead of creating
+    # a loose object file for each. Objects must be flushed before any
+    # reference to them is written.
+    def __init__(self, repo, limit=1 << 30):
+        super().__init__()
+        self.repo = repo
+        self.limit = limit
+        self.objects = dict()
+        self.size = 0
+        # Highest priority, so new objects are written here
+        repo.odb.add_backend(self, 1000)
+
+    def exists_cb(self, oid):
+        return oid in self.objects
+
+    def read_cb(self, oid):
+        type, size, data = self.objects[oid]
+        return type, zlib.decompress(data)
+
+    # Only full object ids are looked up by these programs
+    def read_prefix_cb(self, oid):
+        type, data = self.read_cb(oid)
+        return type, data, oid
+
+    def read_header_cb(self, oid):
+        type, size, data = self.objects[oid]
+        return type, size
+
+    def write_cb(self, oid, data, type):
+        size = len(data)
+        data = zlib.compress(data)
+        self.objects[oid] = (type, size, data)
+        self.size += len(data)
+        if self.size > self.limit:
+            self.flush()
+
+    def refresh_cb(self):
+        pass
+
+    def flush(self):
+        if not self.objects:
+            return
+        pack_dir = os.path.join(self.repo.path, "objects", "pack")
+        tmp = os.path.join(pack_dir, "tmp_pack_igh_%d" % os.getpid())
+
+        # Write pack, without deltas
+        entries = []
+        checksum = hashlib.sha1()
+        with open(tmp + ".pack", "wb") as f:
+            def write(data):
+                checksum.update(data)
+                f.write(data)
+            write(struct.pack(">4sLL", b"PACK", 2, len(self.objects)))
+            offset = 12
+            for oid, (type, size, data) in self.objects.items():
+                header = bytearray()
+                c = type << 4 | size & 15
+                size >>= 4
+                while size:
+                    header.append(c | 0x80)
+                    c = size & 0x7f
+                    size >>= 7
+                header.append(c)
+                write(header)
+                write(data)
+                entries.append((oid.raw, zlib.crc32(data, zlib.crc32(header)), offset))
+                offset += len(header) + len(data)
+            pack_checksum = checksum.digest()
+            f.write(pack_checksum)
+
+        # Write version 2 index
+        entries.sort()
+        fanout = [0] * 256
+        for oid, crc, offset in entries:
+            fanout[oid[0]] += 1
+        for i in range(1, 256):
+            fanout[i] += fanout[i - 1]
+        offsets = array.array("I")
+        large = array.array("Q")
+        for oid, crc, offset in entries:
+            if offset < 0x80000000:
+                offsets.append(offset)
+            else:
+                offsets.append(0x80000000 | len(large))
+                large.append(offset)
+        if sys.byteorder == "little":
+            offsets.byteswap()
+            large.byteswap()
+        index = bytearray(b"\377tOc" + struct.pack(">L256L", 2, *fanout))
+        index += b"".join(oid for oid, crc, offset in entries)
+        index += b"".join(struct.pack(">L", crc) for oid, crc, offset in entries)
+        index += offsets.tobytes() + large.tobytes() + pack_checksum
+        index += hashlib.sha1(index).digest()
+        with open(tmp + ".idx", "wb") as f:
+            f.write(index)
+
+        # The pack is found through its index, so rename that last
+        name = os.path.join(pack_dir, "pack-" + pack_checksum.hex())
+        os.replace(tmp + ".pack", name + ".pack")
+        os.replace(tmp + ".idx", name + ".idx")
+        self.objects = dict()
+        self.size = 0
 
 def load_repository(name, repo, prefix="refs/heads/"):
-
-    def load_commit(oid):
-        c = commits.get(oid)
-        if c is not None:
-            return c
-        c1 = repo[oid]
-        if isinstance(c1, pygit2.Tag):
-            c = load_commit(c1.target)
-        else:
-            c = Commit()
-            c.oid = oid
-            c.author = c1.author
-            c.committer = c1.committer
-            c.message = c1.message.strip()
-            c.tree_id = c1.tree_id
-            c.parents = [load_commit(i) for i in c1.parent_ids]
-        commits[oid] = c
-        return c
-
-    commits = dict()
-    refs = dict()
-
-    for ref1 in repo.listall_references():
-        if ref1.startswith(prefix):
-            ref = repo.lookup_reference(ref1)
-            if ref.type == pygit2.GIT_REF_OID:
-                ref1 = ref1[len(prefix):]
-                commit_list = list(load_commit(ref.target))
-                min_time = 0
-                for commit in reversed(commit_list):
-                    if commit.committer.time < min_time:
-                        commit.committer = pygit2.Signature(email=commit.committer.email, name=commit.committer.name, time=min_time)
-                    new_time = redate_map.get(str(commit.oid))
-                    if new_time is not None:
-                        new_time = int(datetime.datetime.strptime(new_time, "%Y-%m-%dT%H:%M:%S.%fZ").timestamp())
-                        if new_time > min_time:
-                            min_time = new_time
-                refs[ref1] = commit_list
-
-    return refs
+    return CommitStore(repo, prefix)
 
 
 __parse_modules_re = re.compile(
     r"^\[[ \t]*submodule[ \t]+\"([^\n]*)\"[ \t]*]\n(?:[ \t]+path *= *(\S*)\n|[ \t]+branch *= *(\S*)\n|[ \t]+url *= *(\S*)\n|[ \t]+[^\n]*\n)*", re.MULTILINE)
 
-def convert(repo, branch, product_name, get_branch):
-
-    def add_module(module):
-        index.add(pygit2.IndexEntry(module.path, module.get().oid, pygit2.GIT_FILEMODE_COMMIT))
+modules_cache = dict()
+
+def parse_modules(repo, blob_id):
+    # Blobs are identified by content, so may be cached between repositories
+    modules = modules_cache.get(blob_id)
+    if modules is None:
+        text = repo[blob_id].read_raw().decode("latin1")
+        modules = sorted(x.groups() for x in __parse_modules_re.finditer(text))
+        modules_cache[blob_id] = modules
+    return modules
+
+def scan_modules(repo, branch):
+    # Find every submodule referred to in the history of a branch
+    blobs = set()
+    for i in range(len(branch)):
+        try:
+            blobs.add(repo[branch.commit(i).tree_id][".gitmodules"].id)
+        except KeyError:
+            pass
+
+    modules = set()
+    for blob_id in blobs:
+        for name, path, tag, url in parse_modules(repo, blob_id):
+            modules.add((name, url, tag or "master"))
+    return modules
+
+def prefetch(jobs, fetch, items):
+    # Network operations release the GIL, so threads are sufficient
+    with concurrent.futures.ThreadPoolExecutor(jobs) as pool:
+        for _ in pool.map(fetch, items):
+            pass
+
+# Changing either table changes the output, so invalidates checkpoints
+tables_hash = hashlib.sha1(json.dumps([path_map, redate_map], sort_keys=True).encode()).hexdigest()
+
+def load_checkpoint(repo, checkpoint, product_name):
+    try:
+        with open(checkpoint) as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        return None
+    if state.get("version") != 2 or state.get("tables") != tables_hash or state.get("product") != product_name:
+        return None
+    if pygit2.Oid(hex=state["output"]) not in repo:
+        return None
+    return state
+
+def save_checkpoint(checkpoint, state):
+    os.makedirs(os.path.dirname(checkpoint), exist_ok=True)
+    with open(checkpoint + ".new", "w") as f:
+        json.dump(state, f)
+    os.replace(checkpoint + ".new", checkpoint)
+
+# Index of the first all commits commit containing each submodule commit,
+# saved as a line of JSON listing the paths, followed by records sorted by
+# submodule commit and path number.
+module_record = struct.Struct(">20sI20s")
+
+def save_module_index(path, product_name, entries):
+    paths = sorted({p for p, oid in entries})
+    numbers = {p: i for i, p in enumerate(paths)}
+    records = sorted((oid, numbers[p], out) for (p, oid), out in entries.items())
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".new", "wb") as f:
+        f.write(json.dumps({"version": 1, "product": product_name, "paths": paths}).encode() + b"\n")
+        f.write(b"".join(module_record.pack(*r) for r in records))
+    os.replace(path + ".new", path)
+
+class ModuleIndex:
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            header = json.loads(f.readline().decode())
+            if header.get("version") != 1:
+                raise RuntimeError("Unsupported index " + path)
+            self.start = f.tell()
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.product = header["product"]
+        self.paths = header["paths"]
+        self.count = (len(self.data) - self.start) // module_record.size
+
+    def record(self, i):
+        oid, path, out = module_record.unpack_from(self.data, self.start + i * module_record.size)
+        return oid, self.paths[path], out
+
+    def items(self):
+        for i in range(self.count):
+            oid, path, out = self.record(i)
+            yield (path, oid), out
+
+    def lookup(self, prefix):
+        # Returns (path, submodule oid, output oid) for submodule commits
+        # whose hex ids start with prefix
+        prefix = prefix.lower()
+        key = bytes.fromhex((prefix + "0" * 40)[:40])
+        low = 0
+        high = self.count
+        while low < high:
+            mid = (low + high) // 2
+            if self.record(mid)[0] < key:
+                low = mid + 1
+            else:
+                high = mid
+        result = []
+        while low < self.count:
+            oid, path, out = self.record(low)
+            if not oid.hex().startswith(prefix):
+                break
+            result.append((path, pygit2.Oid(raw=oid), pygit2.Oid(raw=out)))
+            low += 1
+        return result
+
+def resume_position(l, count, oid, latest):
+    # Find the first commit not processed by the previous run, assuming
+    # commits have only been added to the newest end of the branch.
+    # Returns None if the history was rewritten, or if a full conversion
+    # would have placed a new commit before the previous output.
+    i = len(l) - count
+    if i < 0 or str(l.oid(i)) != oid:
+        return None
+    i -= 1
+    # Times may go backwards, so check every new commit
+    if i >= 0 and l.position(latest) <= i:
+        return None
+    return i
+
+def resume(repo, branch, product_name, get_branch, checkpoint, index_file):
+    state = load_checkpoint(repo, checkpoint, product_name)
+    if state is None:
+        return None
+    try:
+        module_commits = dict(ModuleIndex(index_file).items())
+    except FileNotFoundError:
+        return None
+    latest = (state["latest"][0], bytes.fromhex(state["latest"][1]))
 
-    # Find first commit in source branch
-    # and create child
     current = CommitPtr(branch, "", product_name)
-    current.index = len(current.list) - 1
-    heap = [current]
-    parents = []
+    current.index = resume_position(branch, *state["superproject"], latest)
+    if current.index is None:
+        return None
+    heap = []
+
+    # Every branch used by earlier super-project commits, as these would
+    # be used again by a full conversion
+    branches = dict()
+    for name, url, tag, count, oid in state["branches"]:
+        l = get_branch(name, url, tag)
+        if resume_position(l, count, oid, latest) is None:
+            return None
+        branches[name, url, tag] = l
+
+    submodules = []
+    for name, url, tag, path, count, oid in state["modules"]:
+        module = CommitPtr(branches[name, url, tag], path, posixpath.basename(path))
+        module.index = resume_position(module.list, count, oid, latest)
+        submodules.append((name, url, tag, module))
+        if module.index >= 0:
+            heapq.heappush(heap, module)
+
+    # Pushed in the same order as after a super-project commit in a full
+    # conversion, so equal commits are taken in the same order
+    if current.index >= 0:
+        heapq.heappush(heap, current)
+    return [pygit2.Oid(hex=state["output"])], submodules, latest, heap, branches, module_commits
+
+def convert(repo, branch, product_name, get_branch, checkpoint=None, rebuild=False):
+
+    def add_module(module):
+        index.add(module.path, module.oid(), pygit2.GIT_FILEMODE_COMMIT)
+        added.append((module.path, module.list.raw_oid(module.index)))
+
+    state = None
+    if checkpoint is not None:
+        index_file = os.path.splitext(checkpoint)[0] + ".index"
+        if not rebuild:
+            state = resume(repo, branch, product_name, get_branch, checkpoint, index_file)
+
+    if state is not None:
+        print(product_name + " resuming conversion")
+        parents, submodules, latest, heap, branches, module_commits = state
+        ptrs = {(name, url, tag, x.path): x for name, url, tag, x in submodules}
+        index = TreeCache(repo, repo[parents[0]].tree_id)
+    else:
+        # Find first commit in source branch
+        # and create child
+        current = CommitPtr(branch, "", product_name)
+        current.index = len(current.list) - 1
+        heap = [current]
+        parents = []
+        submodules = []
+        latest = ()
+        ptrs = dict()
+        branches = dict()
+        module_commits = dict()
+    links = dict()
+    added = []
+    start = time.monotonic()
+    next_progress = start
+    commits = 0
 
     while heap:
 
         current = heap[0]
-        print(product_name, datetime.datetime.utcfromtimestamp(current.get().committer.time))
+        if progress_interval is not None and time.monotonic() >= next_progress:
+            print(product_name, datetime.datetime.utcfromtimestamp(current.time()),
+                  "%d commits, %.0f per second" % (commits, commits / max(time.monotonic() - start, 1e-3)))
+            next_progress = time.monotonic() + progress_interval
+        latest = max(latest, current.list.key(current.index))
 
         if current.path == "":
-            parents.append(current.get().oid)
+            parents.append(current.oid())
             heap = []
-            index = pygit2.Index()
-            index.read_tree(repo[current.get().tree_id])
+            submodules = []
+            tree = current.get().tree
+            index = TreeCache(repo, tree.id)
 
             # Read modules
-            blob_id = index[".gitmodules"].id
+            blob_id = tree[".gitmodules"].id
 
-            text = repo[blob_id].read_raw().decode("latin1")
-            modules = ""
-            for name, path, tag, url in sorted(x.groups() for x in __parse_modules_re.finditer(text)):
+            for name, path, tag, url in parse_modules(repo, blob_id):
 
                 # Load tag or branch
                 if tag is None:
                     tag = "master"
 
-                module = CommitPtr(get_branch(name, url, tag), path, posixpath.basename(path))
+                module = ptrs.get((name, url, tag, path))
+                if module is None:
+                    l = branches.get((name, url, tag))
+                    if l is None:
+                        l = get_branch(name, url, tag)
+                        branches[name, url, tag] = l
+                    module = CommitPtr(l, path, posixpath.basename(path))
+                    ptrs[name, url, tag, path] = module
+                submodules.append((name, url, tag, module))
 
                 # Find latest commit before current
-                while module.index < len(module.list) and module > current:
-                    module.index += 1
+                module.index = module.list.position(current.list.key(current.index))
 
                 if module.index < len(module.list):
                     add_module(module)
+                else:
+                    # No earlier submodule commit, so the superproject's
+                    # own gitlink is kept
+                    try:
+                        entry = tree[path]
+                    except KeyError:
+                        pass
+                    else:
+                        if entry.filemode == pygit2.GIT_FILEMODE_COMMIT:
+                            added.append((path, entry.id.raw))
 
                 # Add symbolic links for moved components
                 link = path_map.get(module.path)
-                if link is not None and current.get().committer.time < rearrange_date:
-                    index.add(pygit2.IndexEntry(link, repo.create_blob(posixpath.relpath(module.path, posixpath.dirname(link))), pygit2.GIT_FILEMODE_LINK))
+                if link is not None and current.time() < rearrange_date:
+                    if link not in links:
+                        links[link] = repo.create_blob(posixpath.relpath(module.path, posixpath.dirname(link)))
+                        stats.counts["blobs"] += 1
+                    index.add(link, links[link], pygit2.GIT_FILEMODE_LINK)
 
                 module.index -= 1
                 if module.index >= 0:
@@ -297,19 +818,45 @@ def convert(repo, branch, product_name, get_branch):
             heapq.heappop(heap)
             add_module(current)
 
-        parents = [repo.create_commit(
-            None,
-            current.get().author,
-            current.get().committer,
-            current.name + ": " + current.get().message,
-            index.write_tree(repo),
-            parents)]
+        commit = current.get()
+        with stats.timer("write_trees"):
+            tree = index.write()
+        with stats.timer("create_commits"):
+            parents = [repo.create_commit(
+                None,
+                commit.author,
+                current.list.committer(current.index),
+                current.name + ": " + commit.message.strip(),
+                tree,
+                parents)]
+        stats.counts["commits"] += 1
+        commits += 1
+
+        out = parents[0].raw
+        for key in added:
+            module_commits.setdefault(key, out)
+        added.clear()
 
         current.index -= 1
         if current.index >= 0:
             heapq.heappush(heap, current)
 
-    print(product_name + " conversion finished")
+    if checkpoint is not None:
+        # Written first, as the commits it refers to are recreated
+        # identically if the checkpoint is not saved
+        save_module_index(index_file, product_name, module_commits)
+        save_checkpoint(checkpoint, {
+            "version": 2,
+            "tables": tables_hash,
+            "product": product_name,
+            "output": str(parents[0]),
+            "latest": [latest[0], latest[1].hex()],
+            "superproject": [len(branch), str(branch.oid(0))],
+            "branches": [[name, url, tag, len(l), str(l.oid(0))] for (name, url, tag), l in branches.items()],
+            "modules": [[name, url, tag, x.path, len(x.list), str(x.list.oid(0))] for name, url, tag, x in submodules]
+        })
+
+    print(product_name + " conversion finished, %d commits" % commits)
     return parents[0]
 
 
@@ -328,8 +875,10 @@ def open_repository(source, path, update=False):
                 pass
             else:
                 print("Fetching", source)
-                remote.fetch(refspecs=remote.fetch_refspecs)
+                with stats.timer("fetch"):
+                    remote.fetch(refspecs=remote.fetch_refspecs)
     else:
         print("Cloning", source)
-        r = pygit2.clone_repository(source, path, bare=True, remote=init_remote)
+        with stats.timer("fetch"):
+            r = pygit2.clone_repository(source, path, bare=True, remote=init_remote)
     return r